@@ -0,0 +1,242 @@
+"""
+Tests for the Flask web app (web_app.py), running stub shell scripts in place of
+the AIrsenal commands.
+"""
+
+import gzip
+import json
+import threading
+
+import pytest
+
+pytest.importorskip("flask")
+pytest.importorskip("orjson")
+
+import web_app
+
+# Each stub prints its name and arguments, so replayed output can be told apart
+STUB_SCRIPT = 'echo "$(basename "$0") $@ $FPL_TEAM_ID"\n'
+
+
+def write_stub(tmp_path, monkeypatch, entry_point, script=STUB_SCRIPT):
+    """Replace an entry point with a shell script in tmp_path"""
+    path = tmp_path / entry_point
+    path.write_text("#!/bin/sh\n" + script)
+    path.chmod(0o755)
+    monkeypatch.setitem(web_app.ENTRY_POINT_PATHS, entry_point, str(path))
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """Test client with stub commands, an empty process registry and result cache"""
+    monkeypatch.setattr(web_app, "AIRSENAL_DIR", str(tmp_path))
+    monkeypatch.setattr(web_app, "active_processes", {})
+    monkeypatch.setattr(web_app, "result_cache", {})
+    monkeypatch.setattr(web_app, "MAX_RUNNING_COMMANDS", 5)
+    for entry_point, _, _ in web_app.COMMANDS.values():
+        write_stub(tmp_path, monkeypatch, entry_point)
+    return web_app.app.test_client()
+
+
+def start(client, action, **kwargs):
+    """Request a command, returning the JSON response"""
+    response = client.post("/run_command", json={"action": action, **kwargs})
+    return response.get_json()
+
+
+def stream(client, process_id, headers=None):
+    """Read a process's SSE stream until the command finishes"""
+    return client.get(f"/stream/{process_id}", headers=headers).get_data()
+
+
+def run(client, action, **kwargs):
+    """Run a command to completion, returning the JSON response and its stream"""
+    data = start(client, action, **kwargs)
+    return data, stream(client, data["process_id"])
+
+
+def parse_frames(body):
+    """Parse an SSE stream into (event ID, data) pairs, skipping comments"""
+    frames = []
+    for frame in body.split(b"\n\n"):
+        event_id, data = None, None
+        for line in frame.split(b"\n"):
+            if line.startswith(b"id: "):
+                event_id = int(line[4:])
+            elif line.startswith(b"data: "):
+                data = json.loads(line[6:])
+        if data is not None:
+            frames.append((event_id, data))
+    return frames
+
+
+def parse_output(body):
+    """The pieces of command output sent in an SSE stream"""
+    return [data["output"] for _, data in parse_frames(body) if "output" in data]
+
+
+def test_stream_sends_whole_lines(client, tmp_path, monkeypatch):
+    write_stub(
+        tmp_path,
+        monkeypatch,
+        "airsenal_update_db",
+        "printf 'abc'; sleep 0.3; printf 'def\\n'; sleep 0.3\n"
+        "printf ' 10%%\\r'; sleep 0.3; printf ' 20%%\\r'; sleep 0.3\n"
+        "printf 'no newline'\n",
+    )
+    _, body = run(client, "update")
+    # A partial line waits for the rest of it, or for the end of the output, and
+    # each progress bar redraw is sent as it is written
+    assert parse_output(body) == ["abcdef\n", " 10%\r", " 20%\r", "no newline"]
+    assert parse_frames(body)[-1][1] == {
+        "complete": True,
+        "success": True,
+        "error": None,
+    }
+
+
+def test_stream_resumes_from_last_event_id(client, tmp_path, monkeypatch):
+    write_stub(
+        tmp_path,
+        monkeypatch,
+        "airsenal_update_db",
+        "echo first\nwhile [ ! -f go ]; do sleep 0.01; done\necho second\n",
+    )
+    process_id = start(client, "update")["process_id"]
+
+    # Read up to the first output, then disconnect
+    response = client.get(f"/stream/{process_id}")
+    received = b""
+    for chunk in response.response:
+        received += chunk
+        if b"id: " in received:
+            break
+    response.close()
+    [(event_id, data)] = parse_frames(received)[1:]
+    assert data == {"output": "first\n"}
+    assert event_id == len(b"first\n")
+
+    (tmp_path / "go").touch()
+    body = stream(client, process_id, headers={"Last-Event-ID": str(event_id)})
+    assert parse_output(body) == ["second\n"]
+    assert parse_frames(body)[-2][0] == len(b"first\nsecond\n")
+
+
+def test_stream_last_event_id_beyond_output(client):
+    process_id = start(client, "update")["process_id"]
+    body = stream(client, process_id, headers={"Last-Event-ID": "1000000"})
+    assert parse_output(body) == []
+    assert parse_frames(body)[-1][1]["complete"]
+
+
+def test_stream_gzip(client):
+    _, plain = run(client, "update")
+    process_id = start(client, "update")["process_id"]
+    response = client.get(f"/stream/{process_id}", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.get_data()) == plain
+
+
+def test_identical_run_is_replayed(client):
+    first, first_output = run(client, "optimize", fpl_team_id="123", weeks_ahead=2)
+    assert b"airsenal_run_optimization --weeks_ahead 2 123" in first_output
+    assert "cached" not in first
+    # The finished run is kept for replaying, log file included
+    assert web_app.is_cached(first["process_id"])
+
+    second, second_output = run(client, "optimize", fpl_team_id="123", weeks_ahead=2)
+    assert second == {"process_id": first["process_id"], "cached": True}
+    assert second_output == first_output
+
+
+def test_fresh_run_is_not_replayed(client):
+    first, _ = run(client, "optimize", fpl_team_id="123")
+    second, _ = run(client, "optimize", fpl_team_id="123", fresh=True)
+    assert second["process_id"] != first["process_id"]
+    assert "cached" not in second
+    # The fresh run replaces the cached one
+    third = start(client, "optimize", fpl_team_id="123")
+    assert third == {"process_id": second["process_id"], "cached": True}
+
+
+def test_optimize_with_other_team_id_is_not_replayed(client):
+    first, _ = run(client, "optimize", fpl_team_id="123")
+    second, output = run(client, "optimize", fpl_team_id="456")
+    assert second["process_id"] != first["process_id"]
+    assert "cached" not in second
+    assert b"456" in output
+
+
+def test_predict_is_replayed_for_any_team_id(client):
+    first, _ = run(client, "predict", fpl_team_id="123")
+    second = start(client, "predict", fpl_team_id="456")
+    assert second == {"process_id": first["process_id"], "cached": True}
+
+
+def test_pipeline_is_not_cached(client):
+    first, _ = run(client, "pipeline", fpl_team_id="123")
+    second, _ = run(client, "pipeline", fpl_team_id="123")
+    assert second["process_id"] != first["process_id"]
+    assert "cached" not in second
+
+
+@pytest.mark.parametrize(
+    ("action", "kwargs"), [("predict", {"weeks_ahead": 5}), ("update", {})]
+)
+def test_invalidated_by_later_command(client, action, kwargs):
+    first, _ = run(client, "optimize", fpl_team_id="123")
+    run(client, action, fpl_team_id="123", **kwargs)
+    second, _ = run(client, "optimize", fpl_team_id="123")
+    assert second["process_id"] != first["process_id"]
+    assert "cached" not in second
+
+
+def test_run_started_before_invalidation_is_not_cached(client, tmp_path, monkeypatch):
+    # The optimization finishes only once the 'go' file exists (the commands run
+    # with tmp_path as their working directory)
+    write_stub(
+        tmp_path,
+        monkeypatch,
+        "airsenal_run_optimization",
+        "while [ ! -f go ]; do sleep 0.01; done\n" + STUB_SCRIPT,
+    )
+    first = start(client, "optimize", fpl_team_id="123")
+    run(client, "update", fpl_team_id="123")
+    (tmp_path / "go").touch()
+    stream(client, first["process_id"])
+    assert web_app.result_cache == {}
+
+    second = start(client, "optimize", fpl_team_id="123")
+    assert second["process_id"] != first["process_id"]
+    assert "cached" not in second
+
+
+def test_remove_process_during_invalidation(client, tmp_path, monkeypatch):
+    """The cache can be invalidated while remove_process is checking it"""
+
+    def invalidate():
+        with web_app.start_lock:
+            web_app.invalidate_results()
+
+    class InvalidatedOnRead(dict):
+        """Result cache that another thread invalidates whenever it is read"""
+
+        def get(self, *args):
+            value = super().get(*args)
+            thread = threading.Thread(target=invalidate)
+            thread.start()
+            # The thread finishes unless start_lock is held during the read
+            thread.join(timeout=0.1)
+            return value
+
+    cache_key = ("optimize", "123", 3)
+    monkeypatch.setattr(
+        web_app, "result_cache", InvalidatedOnRead({cache_key: "optimize_1"})
+    )
+    web_app.active_processes["optimize_1"] = {
+        "cache_key": cache_key,
+        "log_path": str(tmp_path / "optimize_1.log"),
+    }
+    web_app.remove_process("optimize_1")
+    assert web_app.active_processes == {}
+    assert web_app.result_cache == {}
@@ -4,424 +4,398 @@ Simple web application for AIrsenal using Flask
 This file creates a basic web interface for the AIrsenal Fantasy Premier League optimization tool.
 """
 
-from flask import Flask, render_template_string, request, jsonify, Response
+from flask import Flask, request, jsonify, Response
+from flask.json.provider import JSONProvider
+import orjson
+import atexit
+import contextlib
+import fcntl
+import gzip
+import hashlib
 import subprocess
-import json
 import os
+import select
+import shutil
 import sys
 import threading
 import logging
+import logging.handlers
 import queue
+import tempfile
 import time
+import uuid
+import zlib
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging. Handlers only put records on a queue; a listener thread does the
+# actual writing, so a slow log destination can't hold up requests or output readers.
+log_queue = queue.SimpleQueue()
+logging.basicConfig(
+    level=logging.INFO, handlers=[logging.handlers.QueueHandler(log_queue)]
+)
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
-# Add the airsenal directory to the Python path
-sys.path.insert(0, '/airsenal')
+# Add the airsenal directory to the Python path (commands also run from there)
+AIRSENAL_DIR = '/airsenal'
+sys.path.insert(0, AIRSENAL_DIR)
 
 # Set up environment variables if not already set
 if 'AIRSENAL_HOME' not in os.environ:
     os.environ['AIRSENAL_HOME'] = '/tmp'
 
+class OrjsonProvider(JSONProvider):
+    """JSON provider for Flask using orjson, which is much faster than the stdlib"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
-# Store active processes
+# Store active processes. This registry lives in memory, so a stream must be served
+# by the same process that started the command: run the app as a single process
+# (threads are fine), not as several gunicorn workers.
 active_processes = {}
 
-# HTML template for the web interface
-HTML_TEMPLATE = """
-<!DOCTYPE html>
-<html>
-<head>
-    <title>AIrsenal - Fantasy Premier League Optimizer</title>
-    <style>
-        body {
-            font-family: Arial, sans-serif;
-            max-width: 1200px;
-            margin: 0 auto;
-            padding: 20px;
-            background-color: #f5f5f5;
-        }
-        h1 {
-            color: #333;
-            text-align: center;
-        }
-        .container {
-            background-color: white;
-            padding: 20px;
-            border-radius: 8px;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-            margin-bottom: 20px;
-        }
-        .form-group {
-            margin-bottom: 15px;
-        }
-        label {
-            display: block;
-            margin-bottom: 5px;
-            font-weight: bold;
-        }
-        input, select {
-            width: 100%;
-            padding: 8px;
-            border: 1px solid #ddd;
-            border-radius: 4px;
-            box-sizing: border-box;
-        }
-        button {
-            background-color: #4CAF50;
-            color: white;
-            padding: 10px 20px;
-            border: none;
-            border-radius: 4px;
-            cursor: pointer;
-            margin-right: 10px;
-            margin-top: 10px;
-        }
-        button:hover {
-            background-color: #45a049;
-        }
-        button:disabled {
-            background-color: #cccccc;
-            cursor: not-allowed;
-        }
-        .output {
-            background-color: #f0f0f0;
-            padding: 10px;
-            border-radius: 4px;
-            margin-top: 20px;
-            white-space: pre-wrap;
-            font-family: monospace;
-            max-height: 400px;
-            overflow-y: auto;
-        }
-        .error {
-            color: red;
-            margin-top: 10px;
-        }
-        .success {
-            color: green;
-            margin-top: 10px;
-        }
-        .spinner {
-            display: none;
-            margin-left: 10px;
-        }
-        .spinning {
-            display: inline-block;
-            animation: spin 1s linear infinite;
-        }
-        @keyframes spin {
-            0% { transform: rotate(0deg); }
-            100% { transform: rotate(360deg); }
-        }
-        .warning {
-            background-color: #fff3cd;
-            border: 1px solid #ffc107;
-            color: #856404;
-            padding: 10px;
-            border-radius: 4px;
-            margin-bottom: 20px;
-        }
-        .info {
-            color: #0066cc;
-            margin-top: 10px;
-        }
-        }
-    </style>
-</head>
-<body>
-    <h1>⚽ AIrsenal - Fantasy Premier League Optimizer</h1>
-    
-    <div class="container">
-        <div class="warning">
-            ⚠️ <strong>Note:</strong> The initial database setup can take 10-30 minutes as it downloads 3 seasons of data. 
-            Please be patient. Other operations are typically faster.
-        </div>
-    </div>
-    
-    <div class="container">
-        <h2>Configuration</h2>
-        <div class="form-group">
-            <label for="fpl_team_id">FPL Team ID:</label>
-            <input type="text" id="fpl_team_id" placeholder="Enter your FPL Team ID" value="{{ fpl_team_id }}">
-        </div>
-        
-        <div class="form-group">
-            <label for="weeks_ahead">Weeks to Look Ahead:</label>
-            <select id="weeks_ahead">
-                <option value="1">1 Week</option>
-                <option value="2">2 Weeks</option>
-                <option value="3" selected>3 Weeks</option>
-                <option value="4">4 Weeks</option>
-                <option value="5">5 Weeks</option>
-            </select>
-        </div>
-    </div>
-    
-    <div class="container">
-        <h2>Actions</h2>
-        <button onclick="runCommand('setup')">🔧 Setup Initial Database</button>
-        <button onclick="runCommand('update')">🔄 Update Database</button>
-        <button onclick="runCommand('predict')">📊 Run Predictions</button>
-        <button onclick="runCommand('optimize')">🎯 Run Optimization</button>
-        <button onclick="runCommand('pipeline')">🚀 Run Full Pipeline</button>
-        <span class="spinner" id="spinner">⏳ Processing...</span>
-    </div>
-    
-    <div class="container">
-        <h2>Output</h2>
-        <div id="status"></div>
-        <div id="output" class="output"></div>
-    </div>
-    
-    <script>
-        let isRunning = false;
-        let eventSource = null;
-        
-        function runCommand(action) {
-            if (isRunning) {
-                alert('A process is already running. Please wait.');
-                return;
-            }
-            
-            const fplTeamId = document.getElementById('fpl_team_id').value;
-            if (!fplTeamId && action !== 'setup') {
-                alert('Please enter your FPL Team ID first!');
-                return;
-            }
-            
-            isRunning = true;
-            document.getElementById('spinner').style.display = 'inline-block';
-            document.getElementById('status').innerHTML = '<div class="info">Starting ' + action + '...</div>';
-            document.getElementById('output').innerHTML = 'Initializing...\n';
-            
-            // Disable all buttons
-            const buttons = document.querySelectorAll('button');
-            buttons.forEach(btn => btn.disabled = true);
-            
-            const weeksAhead = document.getElementById('weeks_ahead').value;
-            
-            // Start the command
-            fetch('/run_command', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify({
-                    action: action,
-                    fpl_team_id: fplTeamId,
-                    weeks_ahead: weeksAhead
-                })
-            })
-            .then(response => {
-                if (!response.ok) {
-                    throw new Error('Network response was not ok');
-                }
-                return response.json();
-            })
-            .then(data => {
-                if (data.process_id) {
-                    // Start listening for updates
-                    listenForUpdates(data.process_id);
-                } else {
-                    // Handle immediate error
-                    handleComplete(false, data.error || 'Unknown error', '');
-                }
-            })
-            .catch(error => {
-                console.error('Error starting command:', error);
-                handleComplete(false, 'Failed to start command: ' + error.toString(), '');
-            });
-        }
-        
-        function listenForUpdates(processId) {
-            console.log('Listening for updates on process:', processId);
-            
-            // Use Server-Sent Events for real-time updates
-            eventSource = new EventSource('/stream/' + processId);
-            
-            let outputLines = [];
-            
-            eventSource.onmessage = function(event) {
-                try {
-                    const data = JSON.parse(event.data);
-                    
-                    if (data.output) {
-                        outputLines.push(data.output);
-                        // Show last 50 lines
-                        const displayLines = outputLines.slice(-50);
-                        document.getElementById('output').innerHTML = escapeHtml(displayLines.join(''));
-                        // Auto-scroll to bottom
-                        const outputDiv = document.getElementById('output');
-                        outputDiv.scrollTop = outputDiv.scrollHeight;
-                    }
-                    
-                    if (data.status) {
-                        document.getElementById('status').innerHTML = '<div class="info">Status: ' + escapeHtml(data.status) + '</div>';
-                    }
-                    
-                    if (data.complete) {
-                        eventSource.close();
-                        eventSource = null;
-                        handleComplete(data.success, data.error, outputLines.join(''));
-                    }
-                } catch (err) {
-                    console.error('Error parsing SSE data:', err, 'Raw data:', event.data);
-                }
-            };
-            
-            eventSource.onerror = function(error) {
-                console.error('SSE error:', error);
-                if (eventSource) {
-                    eventSource.close();
-                    eventSource = null;
-                }
-                if (isRunning) {
-                    handleComplete(false, 'Connection to server lost. The command may still be running.', outputLines.join(''));
-                }
-            };
-        }
-        
-        function handleComplete(success, error, output) {
-            isRunning = false;
-            document.getElementById('spinner').style.display = 'none';
-            
-            // Enable all buttons
-            const buttons = document.querySelectorAll('button');
-            buttons.forEach(btn => btn.disabled = false);
-            
-            if (success) {
-                document.getElementById('status').innerHTML = '<div class="success">✓ Command completed successfully!</div>';
-            } else {
-                document.getElementById('status').innerHTML = '<div class="error">✗ Error: ' + escapeHtml(error || 'Unknown error') + '</div>';
-            }
-            
-            if (!output || output.trim() === '') {
-                document.getElementById('output').innerHTML = 'No output captured.';
-            }
-        }
-        
-        function escapeHtml(text) {
-            const div = document.createElement('div');
-            div.textContent = text;
-            return div.innerHTML;
-        }
-        
-        // Clean up on page unload
-        window.addEventListener('beforeunload', function() {
-            if (eventSource) {
-                eventSource.close();
-            }
-        });
-    </script>
-</body>
-</html>
-"""
+# Maximum number of commands allowed to run at once; further requests are told to
+# retry after RETRY_AFTER seconds. start_lock makes checking and starting atomic, and
+# is held when removing processes so the registry doesn't change while it is counted.
+MAX_RUNNING_COMMANDS = int(os.environ.get('AIRSENAL_MAX_JOBS', '2'))
+RETRY_AFTER = 60
+start_lock = threading.Lock()
+
+# Entry point, whether it takes --weeks_ahead, and timeout (seconds) for each action.
+# These run as separate processes rather than in-process: the entry points parse
+# sys.argv, start their own multiprocessing pools and can only set the
+# multiprocessing start method once per interpreter.
+COMMANDS = {
+    'setup': ('airsenal_setup_initial_db', False, 1800),  # 30 minutes for initial setup
+    'update': ('airsenal_update_db', False, 600),  # 10 minutes for update
+    'predict': ('airsenal_run_prediction', True, 900),  # 15 minutes
+    'optimize': ('airsenal_run_optimization', True, 1200),  # 20 minutes
+    'pipeline': ('airsenal_run_pipeline', True, 2400)  # 40 minutes
+}
+
+# Look up each entry point on the PATH once, rather than on every run. One that
+# isn't installed yet keeps its bare name, so it is still looked up at run time.
+ENTRY_POINT_PATHS = {
+    entry_point: shutil.which(entry_point) or entry_point
+    for entry_point, _, _ in COMMANDS.values()
+}
+
+# Successful runs of these actions are kept for RESULT_CACHE_TTL seconds and replayed
+# for identical requests, keyed by (action, FPL team ID, weeks ahead); the value says
+# whether the result depends on the team ID, and if not it is left out of the key.
+# The pipeline isn't cached, as each run should fetch fresh FPL data. Starting an
+# action that writes data they depend on (new FPL data, or new predictions for the
+# optimizer) invalidates them, including any run started before that. The optimizer
+# also reads the team's current squad from the FPL API, which this can't see change,
+# so the TTL is short and a request with 'fresh' set always runs the command.
+CACHED_ACTIONS = {'predict': False, 'optimize': True}
+INVALIDATING_ACTIONS = {'setup', 'update', 'predict', 'pipeline'}
+RESULT_CACHE_TTL = 15 * 60
+RESULT_CACHE_SIZE = 32
+result_cache = {}
+
+# Range that the requested number of weeks ahead is clamped to
+MIN_WEEKS_AHEAD = 1
+MAX_WEEKS_AHEAD = 10
+
+# Size of the reads from a command's output pipe
+READ_CHUNK_SIZE = 65536
+
+# Capacity to give a command's output pipe (Linux only; the default is 64KB), so a
+# burst of output doesn't block the command while the reader catches up
+PIPE_BUFFER_SIZE = 1 << 20
+
+# Command output is kept in one log file per process in this directory, rather
+# than in memory. The directory is removed when the server exits.
+LOG_DIR = tempfile.mkdtemp(prefix='airsenal_web_')
+atexit.register(shutil.rmtree, LOG_DIR, ignore_errors=True)
+
+# Finished processes whose stream has been idle this long (seconds) are removed,
+# checked every REAPER_INTERVAL seconds
+ABANDONED_PROCESS_TTL = 300
+REAPER_INTERVAL = 60
+
+# Seconds of silence after which an SSE stream sends a keepalive comment
+SSE_KEEPALIVE_INTERVAL = 15
+
+# Maximum number of bytes of output sent in a single SSE frame, and how long (seconds)
+# to let new output accumulate before sending it
+SSE_MAX_FRAME_BYTES = 65536
+SSE_BATCH_DELAY = 0.05
+
+# Pre-serialized constant SSE frames
+SSE_STARTED = b'data: {"status":"Command started..."}\n\n'
+SSE_NOT_FOUND = b'data: {"error":"Process not found","complete":true}\n\n'
+SSE_KEEPALIVE = b': keepalive\n\n'
+SSE_DATA_PREFIX = b'data: '
+SSE_FRAME_END = b'\n\n'
 
-def run_command_with_streaming(command, process_id, timeout=1800):
-    """Execute a shell command and stream output in real-time"""
+# Pre-serialized constant JSON responses
+HEALTH_BODY = b'{"status":"healthy"}'
+CONFIG_BODY = orjson.dumps({'fpl_team_id': os.environ.get('FPL_TEAM_ID', '')})
+INVALID_ACTION_BODY = orjson.dumps({
+    'success': False,
+    'error': 'Invalid action',
+    'message': 'Invalid action specified'
+})
+INVALID_WEEKS_AHEAD_BODY = orjson.dumps({
+    'success': False,
+    'error': 'Invalid weeks_ahead',
+    'message': 'weeks_ahead must be an integer'
+})
+
+# The web interface is a static page; precompute its compressed form and ETag
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+with open(os.path.join(STATIC_DIR, 'index.html'), 'rb') as f:
+    INDEX_HTML = f.read()
+INDEX_HTML_GZIP = gzip.compress(INDEX_HTML, 9)
+INDEX_ETAG = hashlib.md5(INDEX_HTML).hexdigest()
+
+def run_command_with_streaming(
+    command, process_id, timeout=1800, env=None, cache_key=None
+):
+    """Execute a command (an argv list) and stream output in real-time.
+    env, if given, replaces the environment of the command, and if cache_key is
+    given a successful run is added to the result cache under it.
+    Output is appended to a log file, which streams read from by byte offset."""
+    # Store process info
+    process_info = {
+        'status': 'running',
+        'log_path': os.path.join(LOG_DIR, f'{process_id}.log'),
+        'log_size': 0,
+        'output_ready': threading.Condition(),
+        'success': False,
+        'error': None,
+        'complete': False,
+        'last_consumer_ts': time.time(),
+        'cache_key': cache_key
+    }
+    active_processes[process_id] = process_info
+    
     try:
-        logger.info(f"Executing: {command}")
-        
-        # Store process info
-        process_info = {
-            'status': 'running',
-            'output_queue': queue.Queue(),
-            'success': False,
-            'error': None,
-            'complete': False
-        }
-        active_processes[process_id] = process_info
+        logger.info("Executing: %s", ' '.join(command))
         
         # Start the process
         process = subprocess.Popen(
             command,
-            shell=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            cwd='/airsenal',
-            universal_newlines=True,
-            bufsize=1
+            cwd=AIRSENAL_DIR,
+            env=env,
+            bufsize=READ_CHUNK_SIZE
         )
         
-        # Stream output line by line
+        if hasattr(fcntl, 'F_SETPIPE_SZ'):
+            # Larger than the system allows (fs.pipe-max-size); keep the default
+            with contextlib.suppress(OSError):
+                fcntl.fcntl(
+                    process.stdout.fileno(), fcntl.F_SETPIPE_SZ, PIPE_BUFFER_SIZE
+                )
+        
+        # Copy output from the pipe to the log file, waking up any waiting streams,
+        # and kill the process if it runs for longer than the timeout
         def stream_output():
+            start_time = time.monotonic()
+            deadline = start_time + timeout
+            n_lines = 0
+            log_lines = logger.isEnabledFor(logging.DEBUG)
+            output_ready = process_info['output_ready']
             try:
-                while True:
-                    line = process.stdout.readline()
-                    if not line:
-                        break
-                    
-                    # Put line in queue for streaming
-                    process_info['output_queue'].put(line)
-                    logger.info(f"Output: {line.strip()}")
+                fd = process.stdout.fileno()
+                # poll rather than select, which fails for fds above FD_SETSIZE
+                poller = select.poll()
+                poller.register(fd, select.POLLIN)
+                with open(process_info['log_path'], 'wb') as log_file:
+                    while True:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0 or not poller.poll(remaining * 1000):
+                            raise subprocess.TimeoutExpired(command, timeout)
+                        chunk = os.read(fd, READ_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        log_file.write(chunk)
+                        log_file.flush()
+                        n_lines += chunk.count(b'\n')
+                        if log_lines:
+                            logger.debug(
+                                "Output: %s", chunk.decode('utf-8', 'replace').rstrip()
+                            )
+                        with output_ready:
+                            process_info['log_size'] += len(chunk)
+                            output_ready.notify_all()
                 
                 # Wait for process to complete
-                return_code = process.wait()
+                return_code = process.wait(timeout=max(deadline - time.monotonic(), 0))
+                logger.info(
+                    "Command %s finished rc=%d lines=%d elapsed=%.1fs",
+                    command[0], return_code, n_lines, time.monotonic() - start_time
+                )
                 
                 if return_code == 0:
                     process_info['success'] = True
                     process_info['status'] = 'completed'
-                    logger.info(f"Command completed successfully")
+                    cache_result(process_id)
                 else:
                     process_info['success'] = False
                     process_info['error'] = f"Command failed with exit code {return_code}"
                     process_info['status'] = 'failed'
-                    logger.error(f"Command failed with exit code {return_code}")
+                    logger.error("Command failed with exit code %d", return_code)
                     
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+                process_info['success'] = False
+                process_info['error'] = f"Command timed out after {timeout/60} minutes"
+                process_info['status'] = 'timeout'
+                logger.warning("Process %s timed out", process_id)
             except Exception as e:
-                logger.error(f"Error in stream_output: {e}")
+                logger.error("Error in stream_output: %s", e)
+                # Nothing is reading the command's output any more, so stop it
+                process.kill()
+                process.wait()
                 process_info['success'] = False
                 process_info['error'] = str(e)
                 process_info['status'] = 'error'
             finally:
-                # Mark as complete
-                process_info['complete'] = True
-                logger.info(f"Process {process_id} marked as complete")
+                process.stdout.close()
+                # Mark as complete and wake up any stream waiting for output
+                with output_ready:
+                    process_info['complete'] = True
+                    output_ready.notify_all()
+                logger.info("Process %s marked as complete", process_id)
         
         # Start streaming in a separate thread
         thread = threading.Thread(target=stream_output)
         thread.daemon = True
         thread.start()
         
-        # Set a timeout to kill the process if it runs too long
-        def timeout_handler():
-            time.sleep(timeout)
-            if not process_info['complete']:
-                try:
-                    process.kill()
-                    process_info['error'] = f"Command timed out after {timeout/60} minutes"
-                    process_info['status'] = 'timeout'
-                    process_info['complete'] = True
-                    logger.warning(f"Process {process_id} timed out")
-                except:
-                    pass
-        
-        timeout_thread = threading.Thread(target=timeout_handler)
-        timeout_thread.daemon = True
-        timeout_thread.start()
-        
         return True
         
     except Exception as e:
-        logger.error(f"Failed to start command: {str(e)}")
-        active_processes[process_id] = {
-            'status': 'error',
-            'error': str(e),
-            'complete': True,
-            'success': False,
-            'output_queue': queue.Queue()
-        }
+        logger.error("Failed to start command: %s", e)
+        with process_info['output_ready']:
+            process_info['status'] = 'error'
+            process_info['error'] = str(e)
+            process_info['complete'] = True
+            process_info['output_ready'].notify_all()
         return False
 
+def cache_result(process_id):
+    """Add a successful run to the result cache, if it has a cache key (one that
+    isn't cacheable, or was invalidated while it ran, has none)"""
+    process_info = active_processes[process_id]
+    with start_lock:
+        if process_info['cache_key'] is None:
+            return
+        process_info['completed_at'] = time.time()
+        result_cache.pop(process_info['cache_key'], None)
+        if len(result_cache) >= RESULT_CACHE_SIZE:
+            # Evict the oldest result
+            del result_cache[next(iter(result_cache))]
+        result_cache[process_info['cache_key']] = process_id
+
+def cached_result(cache_key):
+    """Return the ID of a fresh cached run for cache_key, or None if there isn't one"""
+    process_id = result_cache.get(cache_key)
+    if process_id is not None and is_cached(process_id):
+        return process_id
+    return None
+
+def is_cached(process_id):
+    """Whether a process is the current, unexpired cached run for its key"""
+    process_info = active_processes.get(process_id)
+    return (
+        process_info is not None
+        and result_cache.get(process_info['cache_key']) == process_id
+        and time.time() - process_info['completed_at'] < RESULT_CACHE_TTL
+    )
+
+def invalidate_results():
+    """Forget all cached runs, and stop runs in progress from being cached.
+    Call with start_lock held."""
+    result_cache.clear()
+    for process_info in active_processes.values():
+        process_info['cache_key'] = None
+
+def remove_process(process_id):
+    """Forget a process and delete its log file"""
+    with start_lock:
+        process_info = active_processes.pop(process_id, None)
+        if process_info is None:
+            return
+        if result_cache.get(process_info['cache_key']) == process_id:
+            result_cache.pop(process_info['cache_key'], None)
+    with contextlib.suppress(OSError):
+        os.remove(process_info['log_path'])
+
+def reap_abandoned_processes():
+    """Periodically remove finished processes whose output nobody has collected"""
+    while True:
+        time.sleep(REAPER_INTERVAL)
+        now = time.time()
+        for process_id, process_info in list(active_processes.items()):
+            try:
+                if is_cached(process_id):
+                    continue
+                idle = now - process_info.get('last_consumer_ts', 0)
+                if process_info.get('complete', False) and idle > ABANDONED_PROCESS_TTL:
+                    remove_process(process_id)
+                    logger.info("Removed abandoned process %s", process_id)
+            except Exception as e:
+                # Keep reaping; an error here must not stop the thread for good
+                logger.error("Error reaping process %s: %s", process_id, e)
+
+reaper_thread = threading.Thread(target=reap_abandoned_processes)
+reaper_thread.daemon = True
+reaper_thread.start()
+
+def sse_output_frame(text, offset):
+    """Build the SSE frame for a piece of command output, without an intermediate dict.
+    The event ID is the log offset after this output, so a reconnecting client
+    resumes from there via Last-Event-ID."""
+    return b'id: %d\ndata: {"output":%s}\n\n' % (offset, orjson.dumps(text))
+
+def sse_frame(payload):
+    """Build the SSE frame for a JSON payload"""
+    return SSE_DATA_PREFIX + orjson.dumps(payload) + SSE_FRAME_END
+
+def gzip_stream(chunks):
+    """Gzip a stream of byte chunks, flushing each so it reaches the client at once"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    try:
+        for chunk in chunks:
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        chunks.close()
+
 @app.route('/')
 def index():
-    """Render the main page"""
-    fpl_team_id = os.environ.get('FPL_TEAM_ID', '')
-    return render_template_string(HTML_TEMPLATE, fpl_team_id=fpl_team_id)
+    """Serve the main page"""
+    headers = {
+        'ETag': f'"{INDEX_ETAG}"',
+        'Cache-Control': 'no-cache',
+        'Vary': 'Accept-Encoding'
+    }
+    if INDEX_ETAG in request.if_none_match:
+        return Response(status=304, headers=headers)
+    if 'gzip' in request.accept_encodings:
+        headers['Content-Encoding'] = 'gzip'
+        return Response(INDEX_HTML_GZIP, mimetype='text/html', headers=headers)
+    return Response(INDEX_HTML, mimetype='text/html', headers=headers)
+
+@app.route('/config')
+def config():
+    """Return the client-side configuration for the main page"""
+    return Response(CONFIG_BODY, mimetype='application/json')
 
 @app.route('/run_command', methods=['POST'])
 def handle_command():
@@ -430,35 +404,55 @@ def handle_command():
     action = data.get('action')
     fpl_team_id = data.get('fpl_team_id')
     weeks_ahead = data.get('weeks_ahead', 3)
+    fresh = bool(data.get('fresh', False))
     
-    # Set FPL_TEAM_ID environment variable if provided
+    # Pass FPL_TEAM_ID to the command if provided, without touching the server's
+    # own environment (which is shared by concurrent requests)
+    cmd_env = None
     if fpl_team_id:
-        os.environ['FPL_TEAM_ID'] = fpl_team_id
+        cmd_env = {**os.environ, 'FPL_TEAM_ID': str(fpl_team_id)}
     
-    # Define commands for each action with appropriate timeouts
-    commands = {
-        'setup': ('airsenal_setup_initial_db', 1800),  # 30 minutes for initial setup
-        'update': ('airsenal_update_db', 600),  # 10 minutes for update
-        'predict': (f'airsenal_run_prediction --weeks_ahead {weeks_ahead}', 900),  # 15 minutes
-        'optimize': (f'airsenal_run_optimization --weeks_ahead {weeks_ahead}', 1200),  # 20 minutes
-        'pipeline': (f'airsenal_run_pipeline --weeks_ahead {weeks_ahead}', 2400)  # 40 minutes
-    }
+    if action not in COMMANDS:
+        return Response(INVALID_ACTION_BODY, mimetype='application/json')
     
-    if action not in commands:
-        return jsonify({
-            'success': False,
-            'error': 'Invalid action',
-            'message': 'Invalid action specified'
-        })
+    try:
+        weeks_ahead = min(max(int(weeks_ahead), MIN_WEEKS_AHEAD), MAX_WEEKS_AHEAD)
+    except (TypeError, ValueError):
+        return Response(INVALID_WEEKS_AHEAD_BODY, mimetype='application/json')
     
-    # Get command and timeout
-    command, timeout = commands[action]
+    # Build the command's argv (no shell involved) and get its timeout
+    entry_point, takes_weeks_ahead, timeout = COMMANDS[action]
+    command = [ENTRY_POINT_PATHS[entry_point]]
+    if takes_weeks_ahead:
+        command += ['--weeks_ahead', str(weeks_ahead)]
     
-    # Generate a unique process ID
-    process_id = f"{action}_{int(time.time())}"
+    # Generate a unique process ID (it also names the process's log file)
+    process_id = f"{action}_{int(time.time())}_{uuid.uuid4().hex[:8]}"
     
-    # Start the command with streaming
-    if run_command_with_streaming(command, process_id, timeout=timeout):
+    # Replay a recent identical run if there is one (unless a fresh run was asked
+    # for), otherwise start the command with streaming, unless too many are already
+    # running
+    cache_key = None
+    if action in CACHED_ACTIONS:
+        team_key = str(fpl_team_id or '') if CACHED_ACTIONS[action] else ''
+        cache_key = (action, team_key, weeks_ahead)
+    with start_lock:
+        cached_id = None if fresh else cached_result(cache_key)
+        if cached_id is not None:
+            logger.info("Replaying cached result %s for %s", cached_id, action)
+            return jsonify({'process_id': cached_id, 'cached': True})
+        n_running = sum(1 for p in list(active_processes.values()) if not p['complete'])
+        if n_running >= MAX_RUNNING_COMMANDS:
+            return jsonify({
+                'success': False,
+                'error': 'Too many commands running, please try again later'
+            }), 429, {'Retry-After': str(RETRY_AFTER)}
+        if action in INVALIDATING_ACTIONS:
+            invalidate_results()
+        started = run_command_with_streaming(
+            command, process_id, timeout=timeout, env=cmd_env, cache_key=cache_key
+        )
+    if started:
         return jsonify({'process_id': process_id})
     else:
         return jsonify({'success': False, 'error': 'Failed to start command'})
@@ -466,56 +460,99 @@ def handle_command():
 @app.route('/stream/<process_id>')
 def stream_output(process_id):
     """Stream command output using Server-Sent Events"""
+    # Resume from the client's last event if this is a reconnection
+    try:
+        start_offset = max(int(request.headers.get('Last-Event-ID', 0)), 0)
+    except ValueError:
+        start_offset = 0
+    
     def generate():
         try:
             if process_id not in active_processes:
-                yield f"data: {json.dumps({'error': 'Process not found', 'complete': True})}\n\n"
+                yield SSE_NOT_FOUND
                 return
             
             process_info = active_processes[process_id]
             
             # Send initial status
-            yield f"data: {json.dumps({'status': 'Command started...'})}\n\n"
+            yield SSE_STARTED
             
-            # Stream output lines
-            while True:
-                # Check for new output
-                try:
-                    while not process_info['output_queue'].empty():
-                        line = process_info['output_queue'].get_nowait()
-                        # Ensure line is properly escaped for JSON
-                        safe_line = line.replace('\\', '\\\\').replace('"', '\\"').replace('\r', '\\r').replace('\n', '\\n')
-                        yield f"data: {json.dumps({'output': line}, ensure_ascii=False)}\n\n"
-                except queue.Empty:
-                    pass
-                except Exception as e:
-                    logger.error(f"Error getting output from queue: {e}")
-                
-                # Check if process is complete
-                if process_info.get('complete', False):
-                    result = {
-                        'complete': True,
-                        'success': process_info.get('success', False),
-                        'error': process_info.get('error', None)
-                    }
-                    yield f"data: {json.dumps(result, ensure_ascii=False)}\n\n"
+            # Stream the log file as it grows, until the process is complete
+            output_ready = process_info['output_ready']
+            offset = seen_size = start_offset
+            with contextlib.ExitStack() as stack:
+                log = None
+                while True:
+                    process_info['last_consumer_ts'] = time.time()
+                    with output_ready:
+                        output_ready.wait_for(
+                            lambda seen_size=seen_size: (
+                                process_info['log_size'] > seen_size
+                                or process_info['complete']
+                            ),
+                            timeout=SSE_KEEPALIVE_INTERVAL
+                        )
+                        size = process_info['log_size']
+                        complete = process_info['complete']
                     
-                    # Clean up
-                    try:
-                        del active_processes[process_id]
-                    except:
-                        pass
-                    break
-                
-                # Small delay to prevent busy waiting
-                time.sleep(0.1)
+                    if size <= seen_size and not complete:
+                        # Comment frame to keep proxies from closing an idle stream
+                        yield SSE_KEEPALIVE
+                        continue
+                    
+                    # Give output arriving in a burst a moment to accumulate, so it
+                    # goes out in one frame rather than many small ones
+                    if not complete and size - offset < SSE_MAX_FRAME_BYTES:
+                        time.sleep(SSE_BATCH_DELAY)
+                        with output_ready:
+                            size = process_info['log_size']
+                            complete = process_info['complete']
+                    seen_size = size
+                    
+                    # Send whole lines only (a partial line waits for the rest, or
+                    # for the end of the output), up to SSE_MAX_FRAME_BYTES at a time
+                    while offset < size:
+                        if log is None:
+                            log = stack.enter_context(
+                                open(process_info['log_path'], 'rb')
+                            )
+                        log.seek(offset)
+                        data = log.read(min(size - offset, SSE_MAX_FRAME_BYTES))
+                        end = max(data.rfind(b'\n'), data.rfind(b'\r')) + 1
+                        if end == 0:
+                            if not complete and len(data) < SSE_MAX_FRAME_BYTES:
+                                break
+                            end = len(data)
+                        offset += end
+                        yield sse_output_frame(
+                            data[:end].decode('utf-8', 'replace'), offset
+                        )
+                    
+                    if complete:
+                        break
+            
+            result = {
+                'complete': True,
+                'success': process_info.get('success', False),
+                'error': process_info.get('error', None)
+            }
+            yield sse_frame(result)
+            
+            # Clean up, keeping the log of a cached run for replaying
+            if not is_cached(process_id):
+                remove_process(process_id)
         except GeneratorExit:
-            logger.info(f"Client disconnected from stream {process_id}")
+            logger.info("Client disconnected from stream %s", process_id)
         except Exception as e:
-            logger.error(f"Error in stream generation: {e}")
-            yield f"data: {json.dumps({'error': str(e), 'complete': True})}\n\n"
+            logger.error("Error in stream generation: %s", e)
+            yield sse_frame({'error': str(e), 'complete': True})
     
-    response = Response(generate(), mimetype='text/event-stream')
+    if 'gzip' in request.accept_encodings:
+        response = Response(gzip_stream(generate()), mimetype='text/event-stream')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Vary'] = 'Accept-Encoding'
     response.headers['Cache-Control'] = 'no-cache'
     response.headers['X-Accel-Buffering'] = 'no'  # Disable nginx buffering
     return response
@@ -523,7 +560,7 @@ def stream_output(process_id):
 @app.route('/health')
 def health():
     """Health check endpoint"""
-    return jsonify({'status': 'healthy'})
+    return Response(HEALTH_BODY, mimetype='application/json')
 
 if __name__ == '__main__':
     # Get port from environment variable (Render sets this)